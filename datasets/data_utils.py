@@ -13,7 +13,7 @@ from datasets.datasets import PongDataset, SonicDataset, PolePositionDataset, Pi
 
 DEFAULT_NUM_WORKERS = 2
 DEFAULT_PREFETCH_FACTOR = 2
-DEFAULT_PIN_MEMORY = False
+DEFAULT_PIN_MEMORY = torch.cuda.is_available()  # pinned host batches allow async H2D copies
 DEFAULT_PERSISTENT_WORKERS = True
 
 
@@ -141,6 +141,42 @@ def data_loaders(train_data, val_data, batch_size, distributed=False, rank=0, wo
     return train_loader, val_loader
 
 
+class CUDAPrefetcher:
+    # cycles over a loader forever, copying the next batch to device on a side CUDA stream
+    # so the H2D transfer overlaps with the current training step (plain .to(device) off CUDA)
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+        self.loader_iter = iter(loader)
+        self._preload()
+
+    def _next_batch(self):
+        try:
+            return next(self.loader_iter)
+        except StopIteration:
+            self.loader_iter = iter(self.loader)  # reset iterator when epoch ends
+            return next(self.loader_iter)
+
+    def _preload(self):
+        x, _ = self._next_batch()
+        if self.stream is None:
+            self.next_x = x.to(self.device)
+            return
+        with torch.cuda.stream(self.stream):
+            self.next_x = x.to(self.device, non_blocking=True)
+
+    def next(self):
+        # make compute stream wait for the copy and mark the batch as used there before reusing the side stream
+        if self.stream is not None:
+            compute_stream = torch.cuda.current_stream(self.device)
+            compute_stream.wait_stream(self.stream)
+            self.next_x.record_stream(compute_stream)
+        x = self.next_x
+        self._preload()
+        return x
+
+
 def load_data_and_data_loaders(dataset, batch_size, num_frames=1, distributed=False, rank=0, world_size=1, fps=15, preload_ratio=1):
     if dataset == 'PONG':
         training_data, validation_data = load_pong(num_frames=num_frames, fps=fps, preload_ratio=preload_ratio)
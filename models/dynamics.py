@@ -3,31 +3,63 @@ import torch.nn as nn
 import math
 from models.positional_encoding import build_spatial_only_pe
 from models.st_transformer import STTransformer
-from einops import repeat
 
 class DynamicsModel(nn.Module):
     def __init__(self, frame_size=(128, 128), patch_size=4, embed_dim=128, num_heads=8,
-                 hidden_dim=128, num_blocks=4, num_bins=4, n_actions=8, conditioning_dim=3, latent_dim=5):
+                 hidden_dim=128, num_blocks=4, num_bins=4, n_actions=8, conditioning_dim=3, latent_dim=5,
+                 factorized_logits=False):
         super().__init__()
         H, W = frame_size
         codebook_size = num_bins**latent_dim
+        self.num_bins = num_bins
+        self.latent_dim = latent_dim
+        self.factorized_logits = factorized_logits
 
         self.latent_embed = nn.Linear(latent_dim, embed_dim)
         self.transformer = STTransformer(embed_dim, num_heads, hidden_dim, num_blocks, causal=True, conditioning_dim=conditioning_dim)
-        self.output_mlp = nn.Linear(embed_dim, codebook_size)
+        if factorized_logits:
+            # one num_bins-way head per latent dim instead of a num_bins^latent_dim-way softmax
+            # (FSQ already quantizes each latent dim independently)
+            self.output_mlp = nn.Linear(embed_dim, latent_dim * num_bins)
+        else:
+            self.output_mlp = nn.Linear(embed_dim, codebook_size)
+        # fsq basis [num_bins^0, ..., num_bins^(L-1)] for converting between codebook indices and per-dim bins
+        self.register_buffer("digit_basis", num_bins**torch.arange(latent_dim, dtype=torch.long), persistent=False)
 
         # shared spatial-only PE (zeros in temporal tail)
         pe_spatial = build_spatial_only_pe((H, W), patch_size, embed_dim, device='cpu', dtype=torch.float32)  # [1,P,E]
         self.register_buffer("pos_spatial_dec", pe_spatial, persistent=False)
+        # copy of the PE pre-cast to the AMP compute dtype (bf16), so forward doesn't re-cast the fp32 buffer every step
+        self.register_buffer("pos_spatial_dec_amp", pe_spatial.to(torch.bfloat16), persistent=False)
 
         # learnable mask token latent
         # TODO; try leanable mask embedding in embed space instead of latent space
         self.mask_token = nn.Parameter(torch.randn(1, 1, 1, latent_dim) * 0.02)  # [1, 1, 1, L]
 
-    def forward(self, discrete_latents, training=True, conditioning=None, targets=None):
+    def embed(self, discrete_latents):
+        # discrete_latents: [B, T, P, L] float
+        # add spatial PE (affects only first 2/3 of dimensions) in place onto the projection output, which skips
+        # allocating a second [B, T, P, E] tensor (eager still runs a separate add kernel, torch.compile can fuse it)
+        # STTransformer adds temporal PE to last 1/3 of dimensions
+        embeddings = self.latent_embed(discrete_latents)  # [B, T, P, E]
+        return embeddings.add_(self.spatial_pe(embeddings.dtype))  # [B, T, P, E]
+
+    def spatial_pe(self, dtype):
+        # PE in the activation dtype, the pre-cast AMP buffer avoids a fresh [1, P, E] cast every forward
+        if self.pos_spatial_dec_amp.dtype == dtype:
+            return self.pos_spatial_dec_amp
+        return self.pos_spatial_dec.to(dtype)  # [1, P, E]
+
+    def set_amp_dtype(self, dtype):
+        # call once AMP is configured to (re)cast the pre-cast PE buffer to the autocast compute dtype
+        self.register_buffer("pos_spatial_dec_amp", self.pos_spatial_dec.to(dtype), persistent=False)
+
+    def forward(self, discrete_latents, training=True, conditioning=None, targets=None, context_cache=None):
         # discrete_latents: [B, T, P, L]
         # targets: [B, T, P] indices
         # conditioning: [B, T, A]
+        # context_cache: optional per-block temporal K/V from build_context_cache, discrete_latents are then
+        # the T timesteps directly after the cached context (and conditioning covers only those timesteps)
         B, T, P, L = discrete_latents.shape
 
         # convert latents to float for embedding
@@ -35,54 +67,90 @@ class DynamicsModel(nn.Module):
 
         # apply MaskGIT random masking during training
         if training and self.training:
-            # per-batch mask ratio in [0.5, 1.0)
-            mask_ratio = 0.5 + torch.rand((), device=discrete_latents.device) * 0.5 
+            # per-sample mask ratio in [0.5, 1.0)
+            mask_ratio = 0.5 + 0.5 * torch.rand(B, 1, 1, device=discrete_latents.device) # [B, 1, 1]
             mask_positions = (torch.rand(B, T, P, device=discrete_latents.device) < mask_ratio) # [B, T, P]
 
             # guarantee at least one unmasked temporal anchor per (B, P)
             # pick a random timestep for each (B,P) and force it to unmask
-            anchor_idx = torch.randint(0, T, (B, P), device=discrete_latents.device)  # [B, P]
-            mask_positions[torch.arange(B)[:, None], anchor_idx, torch.arange(P)[None, :]] = False # [B, T, P]
+            anchor_idx = torch.randint(0, T, (B, 1, P), device=discrete_latents.device)  # [B, 1, P]
+            mask_positions.scatter_(dim=1, index=anchor_idx, value=False) # [B, T, P]
 
             # replace selected latents with mask tokens
-            mask_token = repeat(self.mask_token.to(discrete_latents.device, discrete_latents.dtype), '1 1 1 L -> B T P L', B=B, T=T, P=P) # [B, T, P, L]
-            discrete_latents = torch.where(mask_positions.unsqueeze(-1), mask_token, discrete_latents) # [B, T, P, L]
+            # (mask token broadcasts inside torch.where, no [B, T, P, L] copy; latents are already fp32 like the
+            # parameter, so no cast is needed and gradients flow straight into self.mask_token)
+            discrete_latents = torch.where(mask_positions.unsqueeze(-1), self.mask_token, discrete_latents) # [B, T, P, L]
         else:
             mask_positions = None
 
-        embeddings = self.latent_embed(discrete_latents)  # [B, T, P, E]
-
-        # add spatial PE (affects only first 2/3 of dimensions)
-        # STTransformer adds temporal PE to last 1/3 of dimensions
-        embeddings = embeddings + self.pos_spatial_dec.to(embeddings.device, embeddings.dtype)
-        transformed = self.transformer(embeddings, conditioning=conditioning)  # [B, T, P, E]
+        embeddings = self.embed(discrete_latents)  # [B, T, P, E]
+        if context_cache is not None:
+            transformed = self.transformer.forward_with_cache(embeddings, context_cache, conditioning=conditioning)  # [B, T, P, E]
+        else:
+            transformed = self.transformer(embeddings, conditioning=conditioning)  # [B, T, P, E]
 
-        # transform to logits for each token in codebook
+        # transform to logits for each token in codebook (or for each bin of each latent dim if factorized)
         predicted_logits = self.output_mlp(transformed)  # [B, T, P, L^D]
+        if self.factorized_logits:
+            predicted_logits = predicted_logits.unflatten(-1, (self.latent_dim, self.num_bins))  # [B, T, P, L, num_bins]
 
         # compute masked cross-entropy loss
         loss = None
         if training and self.training:
             assert targets is not None, "target indices are needed for training"
-            Ld = predicted_logits.shape[-1] # L^D
-            logits_flat = predicted_logits.reshape(-1, Ld) # [(B*T*P), L^D]
-            targets_flat = targets.reshape(-1) # [(B*T*P)]
-            mask_flat = mask_positions.reshape(-1).to(torch.float32) # [(B*T*P)]
-            loss_per = nn.functional.cross_entropy(logits_flat, targets_flat, reduction='none')  # [(B*T*P)]
-            denom = mask_flat.sum().clamp_min(1.0)
-            loss = (loss_per * mask_flat).sum() / denom
+            # only masked positions contribute, unmasked targets are skipped via ignore_index
+            if self.factorized_logits:
+                # per-dim cross-entropy on the index's base-num_bins digits, summed over latent dims
+                logits_flat = predicted_logits.reshape(-1, self.num_bins) # [(B*T*P*L), num_bins]
+                target_digits = self.indices_to_digits(targets) # [B, T, P, L]
+                targets_masked = target_digits.masked_fill(~mask_positions.unsqueeze(-1), -100).reshape(-1) # [(B*T*P*L)]
+            else:
+                Ld = predicted_logits.shape[-1] # L^D
+                logits_flat = predicted_logits.reshape(-1, Ld) # [(B*T*P), L^D]
+                targets_masked = targets.masked_fill(~mask_positions, -100).reshape(-1) # [(B*T*P)]
+            denom = mask_positions.sum().clamp_min(1) # int count, keeps the divide in the fp32 loss dtype under bf16 AMP
+            loss = nn.functional.cross_entropy(logits_flat, targets_masked, ignore_index=-100, reduction='sum') / denom
 
         return predicted_logits, mask_positions, loss  # logits, mask, optional loss
 
-    def exp_schedule_torch(self, t, T, P_total, k, device):
-        # t: current step, T: total steps, P_total: total masked positions across the horizon window
-        # exp schedule is P_total * (1 - exp(k * t / T)) / (1 - exp(k))
-        x = t / max(T, 1)
-        k_tensor = torch.tensor(k, device=device)
-        result = P_total * torch.expm1(k_tensor * x) / torch.expm1(k_tensor)
-        if t == T - 1:
-            return torch.tensor(P_total, dtype=result.dtype, device=device)
-        return result
+    def indices_to_digits(self, indices):
+        # indices: [*] codebook indices -> [*, L] per-dim bins (same ordering as FiniteScalarQuantizer)
+        return (indices.unsqueeze(-1) // self.digit_basis) % self.num_bins
+
+    def digits_to_indices(self, digits):
+        # digits: [*, L] per-dim bins -> [*] codebook indices
+        return torch.sum(digits * self.digit_basis, dim=-1)
+
+    def logits_to_indices(self, logits):
+        # argmax codebook indices from forward logits ([*, L^D] or factorized [*, L, num_bins])
+        if self.factorized_logits:
+            return self.digits_to_indices(torch.argmax(logits, dim=-1))
+        return torch.argmax(logits, dim=-1)
+
+    def build_context_cache(self, context_latents, conditioning=None):
+        # run the causal transformer once over fixed context latents and keep each block's temporal K/V
+        # context_latents: [B, T_ctx, P, L]
+        embeddings = self.embed(context_latents.to(dtype=torch.float32))  # [B, T_ctx, P, E]
+        _, kv_cache = self.transformer(embeddings, conditioning=conditioning, return_kv_cache=True)
+        return kv_cache  # per-block (k, v) each [(B*P), heads, T_ctx, head_dim]
+
+    @staticmethod
+    def split_conditioning(conditioning, T_ctx, T_total):
+        # split [B, T_total, A] or [B, T_total - 1, A] conditioning into context and horizon parts
+        # (the shorter form is zero-prepended by AdaptiveNormalizer, so keep that on the context side)
+        if conditioning is None:
+            return None, None
+        offset = T_total - conditioning.shape[1]  # 0 or 1
+        return conditioning[:, :T_ctx - offset], conditioning[:, T_ctx - offset:]
+
+    def exp_schedule(self, T, P_total, k):
+        # T: total steps, P_total: total masked positions across the horizon window
+        # exp schedule is P_total * (1 - exp(k * t / T)) / (1 - exp(k)), as host ints so no per-step tensor or sync
+        denom = math.expm1(k)
+        schedule = [int(math.ceil(P_total * math.expm1(k * t / max(T, 1)) / denom)) for t in range(T)]
+        if T > 0:
+            schedule[-1] = P_total  # last step unmasks everything
+        return schedule  # [T] target number of unmasked positions after each step
 
     @torch.no_grad()
     def forward_inference(self, context_latents, prediction_horizon, num_steps, index_to_latents_fn, conditioning=None, schedule_k=5.0, temperature: float = 0.0):
@@ -99,98 +167,76 @@ class DynamicsModel(nn.Module):
         input_latents = torch.cat([context_latents, mask_latents], dim=1)  # [B, T_ctx+H, P, L]
         mask = torch.ones(B, H, P, 1, dtype=torch.bool, device=device)  # [B, H, P, 1]
 
+        # context never changes across decoding steps and causal attention keeps it from seeing the horizon,
+        # so run it through the transformer once and only re-run the horizon rows against its cached K/V
+        context_conditioning, horizon_conditioning = self.split_conditioning(conditioning, T_ctx, T_ctx + H)
+        context_cache = self.build_context_cache(context_latents, conditioning=context_conditioning)
+
         P_total = H * P  # total masked positions across the horizon window
+        schedule = self.exp_schedule(num_steps, P_total, schedule_k)
+        k_floor = max(P_total // 16, 1)
+        # every row starts fully masked and unmasks the same count each step, so the number of
+        # still-masked positions is identical across B and can be tracked on host (no .item() syncs)
+        num_masked = P_total
+        batch_idx = torch.arange(B, device=device)[:, None]  # [B, 1]
         for m in range(num_steps):
-            n_tokens_raw = self.exp_schedule_torch(m, num_steps, P_total, schedule_k, device)
-
-            # predict logits for current input
-            logits, _, _ = self.forward(input_latents, training=False, conditioning=conditioning, targets=None)  # [B, T_ctx+H, P, L^D]
-            # temperature scaling
-            if temperature and temperature > 0:
-                scaled_logits = logits / float(temperature)
-            else:
-                scaled_logits = logits
-            probs = torch.softmax(scaled_logits, dim=-1)  # [B, T_ctx+H, P, L^D]
+            # predict logits for current horizon input
+            logits, _, _ = self.forward(input_latents[:, T_ctx:], training=False, conditioning=horizon_conditioning, targets=None, context_cache=context_cache)  # [B, H, P, L^D]
             # confidence for unmask selection always from max probability
-            max_probs, _ = torch.max(probs, dim=-1)  # [B, T_ctx+H, P]
-            # choose indices either via argmax (temperature==0) or sampling
+            # choose indices either via sampling at temperature or argmax (temperature==0)
+            # (factorized logits carry an extra L dim here: per-dim bins and per-dim confidences)
             if temperature and temperature > 0:
-                Bc, Tc, Pc, Ld = probs.shape  # Bc=B, Tc=T_ctx+H, Pc=P, Ld=L^D
-                sampled = torch.distributions.Categorical(probs=probs.reshape(-1, Ld)).sample()
-                predicted_indices = sampled.view(Bc, Tc, Pc)  # [B, T_ctx+H, P]
+                probs = torch.softmax(logits / float(temperature), dim=-1)  # [B, H, P, L^D]
+                confidence, _ = torch.max(probs, dim=-1)  # [B, H, P]
+                predicted_indices = torch.multinomial(probs.reshape(-1, probs.shape[-1]), num_samples=1).view(probs.shape[:-1])  # [B, H, P]
+                if self.factorized_logits:
+                    confidence = confidence.prod(dim=-1)  # joint max prob of the independent dims
             else:
-                _, predicted_indices = torch.max(probs, dim=-1)  # [B, T_ctx+H, P]
-
-            horizon_probs = max_probs[:, -H:, :]  # [B, H, P]
-
-            # for each batch element, select tokens to unmask from all masked positions
-            for b in range(B):
-                masked_mask_all = mask[b, :, :, 0]  # [H, P]
-                masked_flat = masked_mask_all.view(-1)  # [H*P]
-                masked_flat_idx = torch.where(masked_flat)[0]  # [num_masked]
-                if masked_flat_idx.numel() == 0:
-                    continue
-
-                # TODO: try to clean this
-                num_masked_b = int(masked_flat_idx.numel())
-                prev_b = P_total - num_masked_b
-                target_unmasked = int(torch.ceil(n_tokens_raw).item())
-                k_floor = max(P_total // 16, 1)
-                k_b = max(k_floor, min(max(target_unmasked - prev_b, 0), num_masked_b))
-
-                pos_probs_flat = horizon_probs[b].contiguous().view(-1)[masked_flat_idx]  # [num_masked]
-                if pos_probs_flat.numel() > k_b:
-                    top_idx = torch.topk(pos_probs_flat, k_b, largest=True).indices
-                    sel_flat = masked_flat_idx[top_idx]
-                else:
-                    sel_flat = masked_flat_idx
-
-                # map back to (h, p)
-                h_sel = torch.div(sel_flat, P, rounding_mode='floor')  # [k_b]
-                p_sel = sel_flat % P  # [k_b]
-
-                # group by unique h and write sampled tokens to input tensor
-                if h_sel.numel() > 0:
-                    unique_h = torch.unique(h_sel, sorted=True)
-                    for uh in unique_h:
-                        mask_h = (h_sel == uh)
-                        p_list = p_sel[mask_h]
-                        if p_list.numel() == 0:
-                            continue
-                        t_abs = T_ctx + int(uh.item())  # absolute time index in [T_ctx, T_ctx+H-1] (for current horizon step)
-                        idx_sel = predicted_indices[b:b+1, t_abs:t_abs+1, p_list]  # [1,1,P_sel]
-                        pred_latents_sel = index_to_latents_fn(idx_sel)  # [1,1,P_sel,L]
-                        input_latents[b:b+1, t_abs:t_abs+1, p_list] = pred_latents_sel
-                        mask[b, int(uh.item()), p_list, 0] = False
+                # argmax is softmax-invariant, and log max prob = max logit - logsumexp ranks positions
+                # exactly like max prob without materializing a [B, H, P, L^D] probs tensor
+                max_logits, predicted_indices = torch.max(logits, dim=-1)  # [B, H, P]
+                confidence = max_logits - torch.logsumexp(logits, dim=-1)  # [B, H, P]
+                if self.factorized_logits:
+                    confidence = confidence.sum(dim=-1)  # joint log max prob of the independent dims
+            if self.factorized_logits:
+                predicted_indices = self.digits_to_indices(predicted_indices)  # [B, H, P]
+
+            # select tokens to unmask from all masked positions, batched across B
+            prev_unmasked = P_total - num_masked
+            k = min(max(schedule[m] - prev_unmasked, k_floor), num_masked)
+
+            # top-k confidences over masked positions only
+            masked_flat = mask[:, :, :, 0].reshape(B, P_total)  # [B, H*P]
+            conf = confidence.reshape(B, P_total).masked_fill(~masked_flat, float('-inf'))  # [B, H*P]
+            sel_flat = torch.topk(conf, k, dim=1, largest=True).indices  # [B, k]
+
+            # map back to (h, p)
+            h_sel = sel_flat // P  # [B, k]
+            p_sel = sel_flat - h_sel * P  # [B, k], reuses the quotient instead of a separate %
+            t_sel = T_ctx + h_sel  # absolute time index in [T_ctx, T_ctx+H-1]
+
+            # write sampled tokens to input tensor in one scatter
+            idx_sel = predicted_indices[batch_idx, h_sel, p_sel]  # [B, k]
+            pred_latents_sel = index_to_latents_fn(idx_sel)  # [B, k, L]
+            input_latents[batch_idx, t_sel, p_sel] = pred_latents_sel.to(input_latents.dtype)
+            mask[batch_idx, h_sel, p_sel, 0] = False
+            num_masked -= k
 
             # early exit if all horizon tokens are unmasked
-            if not mask[:, :, :, 0].any():  # mask: [B,H,P,1]
+            if num_masked == 0:
                 break
 
         # final completion: fill any remaining masked tokens across all horizon steps via argmax
         # TODO: try removing
-        if mask[:, :, :, 0].any():
-            logits, _, _ = self.forward(input_latents, training=False, conditioning=conditioning, targets=None)  # [B, T_ctx+H, P, L^D]
-            if temperature and temperature > 0:
-                scaled_logits = logits / float(temperature)
-            else:
-                scaled_logits = logits
-            probs = torch.softmax(scaled_logits, dim=-1)  # [B, T_ctx+H, P, L^D]
-            _, predicted_indices = torch.max(probs, dim=-1)  # [B, T_ctx+H, P]
-            for b in range(B):
-                h_idx, p_idx = torch.where(mask[b, :, :, 0])  # both [N_remaining]
-                if h_idx.numel() == 0:
-                    continue
-                unique_h = torch.unique(h_idx, sorted=True)
-                for uh in unique_h:
-                    mask_h = (h_idx == uh)
-                    p_list = p_idx[mask_h]
-                    if p_list.numel() == 0:
-                        continue
-                    t_abs = T_ctx + int(uh.item())  # absolute time index
-                    idx_sel = predicted_indices[b:b+1, t_abs:t_abs+1, p_list]  # [1,1,P_sel]
-                    pred_latents_sel = index_to_latents_fn(idx_sel)  # [1,1,P_sel,L]
-                    input_latents[b:b+1, t_abs:t_abs+1, p_list] = pred_latents_sel
-                    mask[b, int(uh.item()), p_list, 0] = False
+        if num_masked > 0:
+            logits, _, _ = self.forward(input_latents[:, T_ctx:], training=False, conditioning=horizon_conditioning, targets=None, context_cache=context_cache)  # [B, H, P, L^D]
+            predicted_indices = self.logits_to_indices(logits)  # [B, H, P] (argmax of softmax(logits / temperature))
+            # write all remaining (b, h, p) at once with a single index_to_latents_fn call
+            b_idx, h_idx, p_idx = torch.where(mask[:, :, :, 0])  # each [N_remaining]
+            t_abs = T_ctx + h_idx  # absolute time index
+            idx_sel = predicted_indices[b_idx, h_idx, p_idx]  # [N_remaining]
+            pred_latents_sel = index_to_latents_fn(idx_sel)  # [N_remaining, L]
+            input_latents[b_idx, t_abs, p_idx] = pred_latents_sel.to(input_latents.dtype)
+            mask[b_idx, h_idx, p_idx, 0] = False
 
         return input_latents # [B, T_ctx + H, P, L]
@@ -31,12 +31,9 @@ class SpatialAttention(nn.Module):
         k = rearrange(self.k_proj(x), 'B T P (H D) -> (B T) H P D', H=self.num_heads)
         v = rearrange(self.v_proj(x), 'B T P (H D) -> (B T) H P D', H=self.num_heads)
 
-        k_t = k.transpose(-2, -1) # [(B*T), H, P, D, P]
-
         # attention(q, k, v) = softmax(qk^T / sqrt(d)) v
-        scores = torch.matmul(q, k_t) / math.sqrt(self.head_dim) # [(B*T), H, P, P]
-        attn_weights = F.softmax(scores, dim=-1) # [(B*T), H, P, P]
-        attn_output = torch.matmul(attn_weights, v) # [(B*T), H, P, D]
+        # fused sdpa (flash / mem-efficient kernels) never materializes the [(B*T), H, P, P] scores
+        attn_output = F.scaled_dot_product_attention(q, k, v) # [(B*T), H, P, D]
         attn_output = rearrange(attn_output, '(B T) H P D -> B T P (H D)', B=B, T=T) # [B, T, P, E]
 
         # out proj to mix head information
@@ -63,7 +60,8 @@ class TemporalAttention(nn.Module):
         self.norm = AdaptiveNormalizer(embed_dim, conditioning_dim)
         self.causal = causal
         
-    def forward(self, x, conditioning=None):
+    def forward(self, x, conditioning=None, kv_cache=None, return_kv=False):
+        # kv_cache: optional (k, v) each [(B*P), H, T_past, D] from earlier timesteps (x holds the T timesteps after them)
         B, T, P, E = x.shape
         
         # project to Q, K, V and split into heads: [B, T, P, E] -> [(B*P), H, T, D] 
@@ -72,18 +70,21 @@ class TemporalAttention(nn.Module):
         k = rearrange(self.k_proj(x), 'b t p (h d) -> (b p) h t d', h=self.num_heads)
         v = rearrange(self.v_proj(x), 'b t p (h d) -> (b p) h t d', h=self.num_heads) # [B, P, H, T, D]
 
-        k_t = k.transpose(-2, -1) # [(B*P), H, T, D, T]
-
-        # attention(q, k, v) = softmax(qk^T / sqrt(d)) v
-        scores = torch.matmul(q, k_t) / math.sqrt(self.head_dim) # [(B*P), H, T, T]
+        # prepend cached past keys/values so queries attend over [T_past + T] timesteps
+        T_past = 0
+        if kv_cache is not None:
+            k_past, v_past = kv_cache
+            T_past = k_past.shape[2]
+            k = torch.cat([k_past, k], dim=2) # [(B*P), H, T_past+T, D]
+            v = torch.cat([v_past, v], dim=2) # [(B*P), H, T_past+T, D]
 
+        # attention(q, k, v) = softmax(qk^T / sqrt(d)) v, via fused sdpa kernels
         # causal mask for each token t in seq, mask out all tokens to the right of t (after t)
-        if self.causal:
-            mask = torch.triu(torch.ones(T, T), diagonal=1).bool().to(x.device)
-            scores = scores.masked_fill(mask, -torch.inf) # [(B*P), H, T, T]
-
-        attn_weights = F.softmax(scores, dim=-1) # [(B*P), H, T, T]
-        attn_output = torch.matmul(attn_weights, v) # [(B*P), H, T, D]
+        # is_causal aligns the mask top-left, so with cached past timesteps pass an explicit mask shifted by T_past
+        attn_mask = None
+        if self.causal and T_past > 0:
+            attn_mask = torch.ones(T, T_past + T, dtype=torch.bool, device=x.device).tril(diagonal=T_past) # [T, T_past+T], True = attend
+        attn_output = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, is_causal=self.causal and T_past == 0) # [(B*P), H, T, D]
         attn_output = rearrange(attn_output, '(b p) h t d -> b t p (h d)', b=B, p=P) # [B, T, P, E]
 
         # out proj to mix head information
@@ -92,6 +93,8 @@ class TemporalAttention(nn.Module):
         # residual and optionally conditioned norm
         out = self.norm(x + attn_out, conditioning) # [B, T, P, E]
 
+        if return_kv:
+            return out, (k, v) # [B, T, P, E], each [(B*P), H, T_past+T, D]
         return out # [B, T, P, E]
 
 class SwiGLUFFN(nn.Module):
@@ -118,12 +121,16 @@ class STTransformerBlock(nn.Module):
         self.temporal_attn = TemporalAttention(embed_dim, num_heads, causal, conditioning_dim)
         self.ffn = SwiGLUFFN(embed_dim, hidden_dim, conditioning_dim)
 
-    def forward(self, x, conditioning=None):
+    def forward(self, x, conditioning=None, kv_cache=None, return_kv=False):
         # x: [B, T, P, E]
-        # out: [B, T, P, E]
+        # out: [B, T, P, E] (and temporal attention (k, v) if return_kv)
         x = self.spatial_attn(x, conditioning)
-        x = self.temporal_attn(x, conditioning)
+        x = self.temporal_attn(x, conditioning, kv_cache=kv_cache, return_kv=return_kv)
+        if return_kv:
+            x, kv = x
         x = self.ffn(x, conditioning)
+        if return_kv:
+            return x, kv
         return x
 
 class STTransformer(nn.Module):
@@ -138,20 +145,42 @@ class STTransformer(nn.Module):
             for _ in range(num_blocks)
         ])
         
-    def forward(self, x, conditioning=None):
-        # x: [B, T, P, E]
-        # conditioning: [B, T, E]
+    def add_temporal_pe(self, x, t_offset=0):
+        # x: [B, T, P, E] holding timesteps [t_offset, t_offset + T)
         B, T, P, E = x.shape
-        tpe = sincos_time(T, self.temporal_dim, x.device, x.dtype)  # [T, E/3]
+        tpe = sincos_time(t_offset + T, self.temporal_dim, x.device, x.dtype)[t_offset:]  # [T, E/3]
 
         # temporal PE (pad with 0s for first 2/3s spatial PE, last 1/3 temporal PE)
         tpe_padded = torch.cat([
             torch.zeros(T, self.spatial_dims, device=x.device, dtype=x.dtype),
             tpe
         ], dim=-1)  # [T, E]
-        x = x + tpe_padded[None, :, None, :]  # [B,T,P,E]
+        return x + tpe_padded[None, :, None, :]  # [B,T,P,E]
+
+    def forward(self, x, conditioning=None, return_kv_cache=False):
+        # x: [B, T, P, E]
+        # conditioning: [B, T, E]
+        x = self.add_temporal_pe(x)
 
         # apply transformer blocks
+        kv_cache = []
         for block in self.blocks:
-            x = block(x, conditioning)
+            if return_kv_cache:
+                x, kv = block(x, conditioning, return_kv=True)
+                kv_cache.append(kv)
+            else:
+                x = block(x, conditioning)
+        if return_kv_cache:
+            return x, kv_cache  # [B,T,P,E], per-block (k, v) each [(B*P), H, T, D]
+        return x
+
+    def forward_with_cache(self, x, kv_cache, conditioning=None):
+        # x: [B, T, P, E] timesteps directly following the cached ones
+        # kv_cache: per-block temporal attention (k, v) from STTransformer.forward(..., return_kv_cache=True)
+        # causal temporal attention means cached timesteps never attend to x, so the cache stays valid
+        # while x changes (e.g. across MaskGIT decoding steps)
+        T_past = kv_cache[0][0].shape[2]
+        x = self.add_temporal_pe(x, t_offset=T_past)
+        for block, kv in zip(self.blocks, kv_cache):
+            x = block(x, conditioning, kv_cache=kv)
         return x
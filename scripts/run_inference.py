@@ -63,6 +63,8 @@ def main():
             latent_action_model = torch.compile(latent_action_model, mode="reduce-overhead", fullgraph=False, dynamic=True)
         dynamics_model = torch.compile(dynamics_model, mode="reduce-overhead", fullgraph=False, dynamic=True)
         print("Compiled all models for inference.")
+    if args.amp:
+        dynamics_model.set_amp_dtype(torch.bfloat16)
 
     # determine how many ground-truth frames we need in each batch: context + generation steps + prediction horizon
     frames_to_load = args.context_window + args.generation_steps * args.prediction_horizon
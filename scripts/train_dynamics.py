@@ -12,7 +12,7 @@ import torch.nn.functional as F
 from models.video_tokenizer import VideoTokenizer
 from models.latent_actions import LatentActionModel
 from models.dynamics import DynamicsModel
-from datasets.data_utils import visualize_reconstruction, load_data_and_data_loaders
+from datasets.data_utils import visualize_reconstruction, load_data_and_data_loaders, CUDAPrefetcher
 from tqdm import tqdm
 import json
 from einops import rearrange
@@ -78,6 +78,7 @@ def main():
         conditioning_dim=unwrap_model(latent_action_model).action_dim,
         latent_dim=args.latent_dim,
         num_bins=args.num_bins,
+        factorized_logits=args.factorized_logits,
     ).to(device)
     if args.checkpoint:
         dynamics_model, _ = load_dynamics_from_checkpoint(args.checkpoint, device, dynamics_model)
@@ -85,9 +86,12 @@ def main():
     # optional DDP, compile, param count, tf32
     print_param_count_if_main(dynamics_model, "DynamicsModel", is_main)
     if args.compile:
-        video_tokenizer = torch.compile(video_tokenizer, mode="reduce-overhead", fullgraph=False, dynamic=True)
-        latent_action_model = torch.compile(latent_action_model, mode="reduce-overhead", fullgraph=False, dynamic=True)
-        dynamics_model = torch.compile(dynamics_model, mode="reduce-overhead", fullgraph=False, dynamic=True)
+        # batch, context length and frame/patch sizes are fixed per run (drop_last loader), so compile static shapes
+        # frozen encoders: cuda graphs for launch overhead, dynamics (most of the FLOPs): autotuned kernels
+        # (torch.compile on a module only covers forward, so compile the encoder methods the loop actually calls)
+        video_tokenizer.tokenize = torch.compile(video_tokenizer.tokenize, mode="reduce-overhead", fullgraph=False, dynamic=False)
+        latent_action_model.encode = torch.compile(latent_action_model.encode, mode="reduce-overhead", fullgraph=False, dynamic=False)
+        dynamics_model = torch.compile(dynamics_model, mode="max-autotune", fullgraph=False, dynamic=False)
         print("Compiled all models for training.")
     dynamics_model = wrap_ddp_if_needed(dynamics_model, ddp['is_distributed'], ddp['local_rank'])
     if args.tf32:
@@ -117,8 +121,9 @@ def main():
     results = {
         'n_updates': 0,
         'dynamics_losses': [],
-        'loss_vals': [],
     }
+    # on-device ring buffer of the last log_interval losses, copied to CPU only at logging steps
+    loss_buf = torch.zeros(args.log_interval, device=device)
 
     # init wandb
     if args.use_wandb and is_main:
@@ -141,25 +146,25 @@ def main():
         **get_dataloader_distributed_kwargs(ddp),
         **data_overrides,
     )
-    train_iter = iter(training_loader)
+    train_prefetcher = CUDAPrefetcher(training_loader, device)
 
-    for i in tqdm(range(0, args.n_updates), disable=not is_main):
-        try:
-            x, _ = next(train_iter)
-        except StopIteration:
-            train_iter = iter(training_loader)  # reset iterator when epoch ends
-            x, _ = next(train_iter)
+    # pre-cast the dynamics PE buffer to the autocast dtype once instead of every step
+    if args.amp:
+        unwrap_model(dynamics_model).set_amp_dtype(torch.bfloat16)
 
-        x = x.to(device, non_blocking=True)  # [batch_size, seq_len, channels, height, width]
+    for i in tqdm(range(0, args.n_updates), disable=not is_main):
+        x = train_prefetcher.next()  # [batch_size, seq_len, channels, height, width]
         optimizer.zero_grad(set_to_none=True)
 
-        # get video tokens for batch
-        video_tokens = video_tokenizer.tokenize(x) # [B, T, P]
-        video_latents = video_tokenizer.quantizer.get_latents_from_indices(video_tokens, dim=-1) # [B, T, P, L]
-        if args.use_actions:
-            quantized_actions = unwrap_model(latent_action_model).encode(x)  # [B, T - 1, A]
-        else:
-            quantized_actions = None
+        # get video tokens for batch (frozen models, so no autograd tracking and bf16 under AMP)
+        # (no_grad rather than inference_mode so the outputs are ordinary tensors for the compiled dynamics step)
+        with torch.no_grad(), torch.amp.autocast('cuda', enabled=bool(args.amp), dtype=torch.bfloat16 if args.amp else None):
+            video_tokens = video_tokenizer.tokenize(x) # [B, T, P]
+            video_latents = video_tokenizer.quantizer.get_latents_from_indices(video_tokens, dim=-1) # [B, T, P, L]
+            if args.use_actions:
+                quantized_actions = unwrap_model(latent_action_model).encode(x)  # [B, T - 1, A]
+            else:
+                quantized_actions = None
 
         # predict masked frame latents with dynamics model (masking in dynamics model)
         with torch.amp.autocast('cuda', enabled=bool(args.amp), dtype=torch.bfloat16 if args.amp else None):
@@ -168,8 +173,7 @@ def main():
             )
 
         results['n_updates'] = i
-        results['dynamics_losses'].append(loss.detach().cpu())
-        results['loss_vals'].append(loss.detach().cpu())
+        loss_buf[i % args.log_interval] = loss.detach()
 
         # clip grads, optimizer step, update scheduler and grad scaler
         scaler.scale(loss).backward()
@@ -179,21 +183,25 @@ def main():
         scaler.update()
         scheduler.step()
 
-        # wandb logging
+        # wandb logging, device values only every wandb_log_interval steps (one small sync instead of one per step)
         if args.use_wandb and is_main:
-            wandb.log({
-                'train/loss': loss.item(),
-            }, step=i)
             log_system_metrics(i)
             log_learning_rate(optimizer, i)
-            if args.use_actions:
-                action_indices = unwrap_model(latent_action_model).quantizer.get_indices_from_latents(quantized_actions)
-                log_action_distribution(action_indices, i, args.n_actions)
+            if i % args.wandb_log_interval == 0:
+                # mean loss over the last wandb_log_interval steps from the ring buffer
+                n = min(i + 1, args.wandb_log_interval, args.log_interval)
+                recent_idx = torch.arange(i - n + 1, i + 1, device=device) % args.log_interval
+                wandb.log({
+                    'train/loss': loss_buf[recent_idx].mean().item(),
+                }, step=i)
+                if args.use_actions:
+                    action_indices = unwrap_model(latent_action_model).quantizer.get_indices_from_latents(quantized_actions)
+                    log_action_distribution(action_indices, i, args.n_actions)
 
         # save model and visualize results
         if i % args.log_interval == 0 and is_main:
             # argmax sample and detokenize dynamics logits
-            predicted_next_indices = torch.argmax(predicted_next_logits, dim=-1)
+            predicted_next_indices = unwrap_model(dynamics_model).logits_to_indices(predicted_next_logits)
             predicted_next_latents = video_tokenizer.quantizer.get_latents_from_indices(predicted_next_indices, dim=-1)
             with torch.no_grad():
                 predicted_frames = video_tokenizer.decoder(predicted_next_latents[:16]) # [B, T, C, H, W]
@@ -202,15 +210,11 @@ def main():
             B, T, P = mask_positions.shape
             patch_size = args.patch_size
             H, W = args.frame_size, args.frame_size
-            pixel_mask = torch.zeros(B, T, H, W, device=mask_positions.device)
-            # for each pixel patch, mask if equivalent token is masked
-            for b in range(B):
-                for t in range(T):
-                    for p in range(P):
-                        if mask_positions[b, t, p]:
-                            patch_row = (p // (W // patch_size)) * patch_size
-                            patch_col = (p % (W // patch_size)) * patch_size
-                            pixel_mask[b, t, patch_row:patch_row+patch_size, patch_col:patch_col+patch_size] = 1 # assigning 1 to the patch in the mask of dim [1, 1, Hp, Wp]
+            Hp, Wp = H // patch_size, W // patch_size
+            assert P == Hp * Wp, f"expected {Hp * Wp} patches per frame, got {P}"
+            # for each pixel patch, mask if equivalent token is masked (upsample [B, T, Hp, Wp] patch mask to pixels)
+            pixel_mask = mask_positions.view(B, T, Hp, Wp).to(torch.float32) # [B, T, Hp, Wp]
+            pixel_mask = pixel_mask.repeat_interleave(patch_size, dim=-2).repeat_interleave(patch_size, dim=-1) # [B, T, H, W]
             pixel_mask_expanded = rearrange(pixel_mask, 'b t h w -> b t 1 h w')
             masked_frames = x * (1 - pixel_mask_expanded)
 
@@ -219,7 +223,10 @@ def main():
             save_path = os.path.join(visualizations_dir, f'dynamics_prediction_step_{i}.png')
             visualize_reconstruction(masked_frames[:16].cpu(), predicted_frames[:16].cpu(), save_path)
 
-            print('\n Step', i, 'Loss:', torch.mean(torch.stack(results["loss_vals"][-args.log_interval:])).item())
+            # roll so the window is in step order (slot 0 holds the current step)
+            window = torch.roll(loss_buf, -1)[-min(i + 1, args.log_interval):].cpu()
+            results['dynamics_losses'].extend(window.tolist())
+            print('\n Step', i, 'Loss:', window.mean().item())
 
     # finish wandb
     if args.use_wandb and is_main:
@@ -4,7 +4,7 @@ import torch.optim as optim
 import sys
 import os
 from models.video_tokenizer import VideoTokenizer
-from datasets.data_utils import visualize_reconstruction, load_data_and_data_loaders
+from datasets.data_utils import visualize_reconstruction, load_data_and_data_loaders, CUDAPrefetcher
 from utils.scheduler_utils import create_cosine_scheduler
 from tqdm import tqdm
 import json
@@ -109,15 +109,9 @@ def main():
 
     unwrap_model(model).train()
 
-    train_iter = iter(training_loader)
+    train_prefetcher = CUDAPrefetcher(training_loader, device)
     for i in tqdm(range(args.n_updates), disable=not is_main):
-        try:
-            (x, _) = next(train_iter)
-        except StopIteration:
-            train_iter = iter(training_loader)  # reset iterator when epoch ends
-            (x, _) = next(train_iter)
-
-        x = x.to(device, non_blocking=True)
+        x = train_prefetcher.next()
         optimizer.zero_grad(set_to_none=True)
 
         # forward + loss under autocast
@@ -100,6 +100,10 @@ class DynamicsConfig:
 	checkpoint: Optional[str]
 	fps: Optional[int] = None
 	preload_ratio: Optional[float] = None
+	# per-latent-dim num_bins-way output heads instead of one num_bins^latent_dim-way softmax
+	factorized_logits: bool = False
+	# steps between wandb loss / action-distribution logs (averaged over the window, no per-step host sync)
+	wandb_log_interval: int = 10
 
 
 @dataclass
@@ -218,6 +218,7 @@ def load_dynamics_from_checkpoint(checkpoint_path, device, model = None):
         'conditioning_dim': conditioning_dim,
         'latent_dim': cfg.get('latent_dim', 6),
         'num_bins': cfg.get('num_bins', 4),
+        'factorized_logits': cfg.get('factorized_logits', False),
     }
     if model is None:
         model = DynamicsModel(**kwargs)